@@ -14,6 +14,16 @@ from io import BytesIO
 import xml.etree.ElementTree as ET
 
 
+# pre-compiled network byte order structs for the fixed size read/write helpers
+_U8 = struct.Struct('!B')
+_S8 = struct.Struct('!b')
+_U16 = struct.Struct('!H')
+_S16 = struct.Struct('!h')
+_U32 = struct.Struct('!L')
+_S32 = struct.Struct('!l')
+_DOUBLE = struct.Struct('!d')
+
+
 # a typed object or received object. Typed object has _classname attr.
 class Object(object):
     def __init__(self, **kwargs):
@@ -45,18 +55,18 @@ class AMFBytesIO(
                                              **kwargs)
 
     # return true if next read will cause EOFError
-    def eof(self): return self.tell() >= len(self.getvalue())
+    def eof(self): return self.remaining() <= 0
 
-    def remaining(self): return len(self.getvalue()) - \
-        self.tell()  # return number of remaining bytes
+    def remaining(self):  # return number of remaining bytes
+        with self.getbuffer() as view:
+            return len(view) - self.tell()
 
     def read(self, length=-1):
-        if length > 0 and self.eof():
+        # BytesIO already stops at the end of the data, an empty result means we were at EOF
+        data = BytesIO.read(self, length)
+        if length > 0 and not data:
             raise EOFError  # raise error if reading beyond EOF
-        if length > 0 and self.tell() + length > len(self.getvalue()):
-            # don't read more than available bytes
-            length = len(self.getvalue()) - self.tell()
-        return BytesIO.read(self, length)
+        return data
 
     def peek(self):
         if self.eof():
@@ -67,46 +77,46 @@ class AMFBytesIO(
             return c
 
     def read_u8(self):
-        return struct.unpack("!B", self.read(1))[0]
+        return _U8.unpack(self.read(1))[0]
 
     def write_u8(self, c):
-        self.write(struct.pack("!B", c))
+        self.write(_U8.pack(c))
 
     def read_s8(self):
-        return struct.unpack("!b", self.read(1))[0]
+        return _S8.unpack(self.read(1))[0]
 
     def write_s8(self, c):
-        self.write(struct.pack("!b", c))
+        self.write(_S8.pack(c))
 
     def read_u16(self):
-        return struct.unpack("!H", self.read(2))[0]
+        return _U16.unpack(self.read(2))[0]
 
     def write_u16(self, c):
-        self.write(struct.pack("!H", c))
+        self.write(_U16.pack(c))
 
     def read_s16(self):
-        return struct.unpack("!h", self.read(2))[0]
+        return _S16.unpack(self.read(2))[0]
 
     def write_s16(self, c):
-        self.write(struct.pack("!h", c))
+        self.write(_S16.pack(c))
 
     def read_u32(self):
-        return struct.unpack("!L", self.read(4))[0]
+        return _U32.unpack(self.read(4))[0]
 
     def write_u32(self, c):
-        self.write(struct.pack("!L", c))
+        self.write(_U32.pack(c))
 
     def read_s32(self):
-        return struct.unpack("!l", self.read(4))[0]
+        return _S32.unpack(self.read(4))[0]
 
     def write_s32(self, c):
-        self.write(struct.pack("!l", c))
+        self.write(_S32.pack(c))
 
     def read_double(self):
-        return struct.unpack("!d", self.read(8))[0]
+        return _DOUBLE.unpack(self.read(8))[0]
 
     def write_double(self, c):
-        self.write(struct.pack("!d", c))
+        self.write(_DOUBLE.pack(c))
 
     def read_utf8(self, length):
         return str(self.read(length), 'utf8')
@@ -140,18 +150,16 @@ class AMFBytesIO(
     def write_u29(self, c):
         if c < 0 or c > 0x1fffffff:
             raise ValueError('uint29 out of range')
-        bytes = ''
-        if c >= 0x200000:
-            bytes += chr(0x80 | ((c >> 22) & 0x7f))
-        if c >= 0x4000:
-            bytes += chr(0x80 | ((c >> 15) & 0x7f))
-        if c >= 0x80:
-            bytes += chr(0x80 | ((c >> 8) & 0x7f))
-        if c >= 0x200000:
-            bytes += chr(c & 0xff)
+        # use the fewest bytes that can hold the value
+        if c < 0x80:
+            data = bytes((c,))
+        elif c < 0x4000:
+            data = bytes((0x80 | (c >> 7), c & 0x7f))
+        elif c < 0x200000:
+            data = bytes((0x80 | (c >> 14), 0x80 | ((c >> 7) & 0x7f), c & 0x7f))
         else:
-            bytes += chr(c & 0x7f)
-        self.write(bytes)
+            data = bytes((0x80 | (c >> 22), 0x80 | ((c >> 15) & 0x7f), 0x80 | ((c >> 8) & 0x7f), c & 0xff))
+        self.write(data)
 
     def write_s29(self, c):
         if c < -0x10000000 or c > 0x0fffffff:
@@ -169,6 +177,8 @@ class AMF0(object):
         self._obj_refs, self.data = list(), data if isinstance(
             data, AMFBytesIO) else AMFBytesIO(data) if data is not None else AMFBytesIO()
 
+    def eof(self): return self.data.eof()  # return true if next read will cause EOFError
+
     def _created(self, obj):  # new object-reference is created
         self._obj_refs.append(obj)
         return obj
@@ -34,6 +34,9 @@ AUDIO_SOUND_RATE = [
   5512, 11025, 22050, 44100
 ]
 
+# FLV audio tag header byte -> (sound_format, sound_type, sound_size, sound_rate)
+AUDIO_TAG_HEADER = tuple(((b >> 4) & 0x0f, b & 0x01, (b >> 1) & 0x01, (b >> 2) & 0x03) for b in range(256))
+
 VIDEO_CODEC_NAME = [
   '',
   'Jpeg',
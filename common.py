@@ -1,6 +1,11 @@
 import struct
 import amf
 
+_U8 = struct.Struct('>B')
+_U16LE = struct.Struct('<H')
+_U32BE = struct.Struct('>I')
+_U32LE = struct.Struct('<I')
+
 VIDEO_CODEC_NAME = [
     '',
     'Jpeg',
@@ -77,33 +82,31 @@ class Header(object):
         self.streamId = streamId  # message stream id
 
         if (channel < 64):
-            self.hdrdata = struct.pack('>B', channel)
+            self.hdrdata = _U8.pack(channel)
         elif (channel < 320):
-            self.hdrdata = b'\x00' + struct.pack('>B', channel - 64)
+            self.hdrdata = b'\x00' + _U8.pack(channel - 64)
         else:
-            self.hdrdata = b'\x01' + struct.pack('>H', channel - 64)
+            self.hdrdata = b'\x01' + _U16LE.pack(channel - 64)  # the 3 byte form stores the id low byte first
 
     def toBytes(self, control):
-        data = (self.hdrdata[0] | control).to_bytes(1, 'big')
-        if len(self.hdrdata) >= 2:
-            data += self.hdrdata[1:]
+        data = bytes([self.hdrdata[0] | control]) + self.hdrdata[1:]
 
         # if the chunk type is not 3
         if control != Header.SEPARATOR:
-            data += struct.pack('>I', self.time if self.time <
+            data += _U32BE.pack(self.time if self.time <
                                 0xFFFFFF else 0xFFFFFF)[1:]  # add time in 3 bytes
             # if the chunk type is not 2
             if control != Header.TIME:
-                data += struct.pack('>I', self.size)[1:]  # add size in 3 bytes
-                data += struct.pack('>B', self.type)  # add type in 1 byte
+                data += _U32BE.pack(self.size)[1:]  # add size in 3 bytes
+                data += _U8.pack(self.type)  # add type in 1 byte
                 # if the chunk type is not 1
                 if control != Header.MESSAGE:
                     # add streamId in little-endian 4 bytes
-                    data += struct.pack('<I', self.streamId)
+                    data += _U32LE.pack(self.streamId)
             # add the extended time part to the header if timestamp[delta] >=
             # 16777215
             if self.time >= 0xFFFFFF:
-                data += struct.pack('>I', self.time)
+                data += _U32BE.pack(self.time)
         return data
 
     def __repr__(self):
@@ -223,8 +226,8 @@ class Command(object):
             else:
                 inst.id = 0
             inst.args = []  # others are optional
-            while True:
-                inst.args.append(amfReader.read())  # amfReader.read())
+            while not amfReader.eof():
+                inst.args.append(amfReader.read())
         except EOFError:
             pass
         return inst
@@ -7,10 +7,20 @@ import struct
 from typing import Optional
 import time
 import handshake
-import uuid
+import itertools
+
+try:
+    # Optional, a libuv based event loop with faster transports
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Config
-LogLevel = logging.INFO
+LogLevel = logging.WARNING # Set to logging.INFO to log connections and publishes, logging.DEBUG for per-packet traces
+ReadBufferLimit = 1024 * 1024 # Per-connection read buffer; a larger buffer lets a publisher burst without pausing the socket
+RecvBufferSize = 64 * 1024 # Initial size of a connection's receive buffer, it grows when a chunk needs more
+RecvBufferMinFree = 4096 # Free space to offer the socket before compacting or growing the receive buffer
+WriteBufferHighWater = 256 * 1024 # Only wait for a connection's writes to drain once this much output is queued
 
 # RTMP packet types
 RTMP_TYPE_SET_CHUNK_SIZE = 1  # Set Chunk Size message (RTMP_PACKET_TYPE_CHUNK_SIZE 0x01) - The Set Chunk Size message is used to inform the peer about the chunk size for subsequent chunks.
@@ -34,6 +44,9 @@ RTMP_CHUNK_TYPE_1 = 1 # 7-bytes: delta(3) + length(3) + stream type(1)
 RTMP_CHUNK_TYPE_2 = 2 # 3-bytes: delta(3)
 RTMP_CHUNK_TYPE_3 = 3 # 0-byte
 
+# Chunk message header size by chunk type
+CHUNK_MESSAGE_HEADER_SIZE = (11, 7, 3, 0)
+
 # RTMP channel constants
 RTMP_CHANNEL_PROTOCOL = 2
 RTMP_CHANNEL_INVOKE = 3
@@ -45,6 +58,56 @@ RTMP_CHANNEL_DATA = 6
 PROTOCOL_CHANNEL_ID = 2
 
 MAX_CHUNK_SIZE = 10485760
+OUT_CHUNK_SIZE = 4096 # Default out chunk size
+
+# Window acknowledgement size and peer bandwidth announced on connect
+WINDOW_ACKNOWLEDGEMENT_SIZE = 5000000
+PEER_BANDWIDTH = 5000000
+PEER_BANDWIDTH_DYNAMIC = 2 # Set Peer Bandwidth limit type
+
+# Pre-compiled structs for 16/32-bit big-endian fields (and a 32-bit field followed by a byte), little-endian stream ids and AMF0 numbers
+_U16BE = struct.Struct('>H')
+_U32BE = struct.Struct('>I')
+_U32LE = struct.Struct('<I')
+_U32BE_U8 = struct.Struct('>IB')
+_DOUBLE = struct.Struct('>d')
+
+# Protocol control message chunk headers on chunk stream 2 (fmt 0, 4 byte body), decoded once at load
+_CHUNK_SIZE_HEADER = bytes.fromhex("020000000000040100000000")
+_ACK_HEADER = bytes.fromhex("020000000000040300000000")
+_WINDOW_ACK_HEADER = bytes.fromhex("020000000000040500000000")
+_PEER_BANDWIDTH_HEADER = bytes.fromhex("020000000000050600000000")
+# A whole control message (chunk header followed by its value) is packed in a single call
+_CONTROL_MESSAGE = struct.Struct('>12sI')
+_CONTROL_MESSAGE_U8 = struct.Struct('>12sIB')
+
+# AMF0 body of the createStream '_result': name, transaction id, null command object, stream id
+_CREATE_STREAM_RESULT = b'\x02\x00\x07_result' + b'\x00' + bytes(8) + b'\x05' + b'\x00' + bytes(8)
+_CREATE_STREAM_RESULT_ID_OFFSET = 11
+_CREATE_STREAM_RESULT_STREAM_OFFSET = 21
+
+# AMF0 body head of 'onStatus': name, transaction id, null command object, start of the info object
+_ON_STATUS = b'\x02\x00\x08onStatus' + b'\x00' + bytes(8) + b'\x05' + b'\x03'
+_ON_STATUS_ID_OFFSET = 12
+
+def _amf0_string(value):
+    # Encode a str as an AMF0 string value (marker, length and utf8 data)
+    data = value.encode('utf8')
+    if len(data) > 0xffff:
+        return bytes([amf.AMF0.LONG_STRING]) + _U32BE.pack(len(data)) + data
+    return bytes([amf.AMF0.STRING]) + _U16BE.pack(len(data)) + data
+
+def parse_message_header(fmt, buf, packet, offset):
+    # Decode a FMT 0, 1 or 2 chunk message header, starting at offset in buf, into the incoming packet of its chunk stream.
+    # The 3 byte fields are unpacked as 32 bit words including the byte before them, so offset must be at least 1 (the basic header precedes it).
+    header = packet.header
+    header.timestamp = _U32BE.unpack_from(buf, offset - 1)[0] & 0xffffff
+    if fmt <= RTMP_CHUNK_TYPE_1:
+        length, header.type = _U32BE_U8.unpack_from(buf, offset + 2)
+        header.length = length & 0xffffff
+        packet.received = 0
+        if fmt == RTMP_CHUNK_TYPE_0:
+            header.stream_id = _U32LE.unpack_from(buf, offset + 7)[0] # Message Stream ID is little-endian
 
 # Constants for Packet Types
 PacketTypeSequenceStart = 0  # Represents the start of a video/audio sequence
@@ -59,6 +122,11 @@ FourCC_AV1 = b'av01'  # AV1 video codec
 FourCC_VP9 = b'vp09'  # VP9 video codec
 FourCC_HEVC = b'hvc1'  # HEVC video codec
 
+# Invoke commands whose optional arguments are never used, so they are not parsed
+_IGNORED_ARGS_COMMANDS = frozenset(('createStream', 'releaseStream', 'FCPublish', 'FCUnpublish', 'getStreamLength'))
+# Invoke commands that are acknowledged without a response
+_IGNORED_COMMANDS = frozenset(('releaseStream', 'FCPublish', 'FCUnpublish', 'getStreamLength'))
+
 # Dictionary to store live users
 LiveUsers = {}
 # Dictionary to store player users
@@ -68,40 +136,87 @@ PlayerUsers = {}
 class DisconnectClientException(Exception):
     pass
 
+# Header of an RTMP message, as received on a chunk stream
+class RTMPHeader:
+    __slots__ = ('fmt', 'cid', 'timestamp', 'length', 'type', 'stream_id')
+
+    def __init__(self, fmt=0, cid=0, timestamp=0, length=0, type=0, stream_id=0):
+        self.fmt = fmt
+        self.cid = cid
+        self.timestamp = timestamp
+        self.length = length  # message length
+        self.type = type  # message type id
+        self.stream_id = stream_id  # message stream id
+
+    def __repr__(self):
+        return (f"<RTMPHeader fmt={self.fmt} cid={self.cid} timestamp={self.timestamp} length={self.length} type={self.type} stream_id={self.stream_id}>")
+
+# RTMP message being assembled on a chunk stream, or a complete one handed to the handlers
+class RTMPPacket:
+    __slots__ = ('header', 'clock', 'payload', 'received', 'extended_timestamp', 'last_received_time')
+
+    def __init__(self, header, payload=None, clock=0):
+        self.header = header
+        self.clock = clock
+        self.payload = bytearray() if payload is None else payload
+        self.received = len(self.payload)  # Bytes of the payload filled so far
+        self.extended_timestamp = 0
+        self.last_received_time = time.monotonic()
+
+    def __repr__(self):
+        return (f"<RTMPPacket header={self.header} clock={self.clock} payload={common.truncate(self.payload)}>")
+
 # Class representing the state of a connected client
 class ClientState:
-    def __init__(self):
-        self.id = str(uuid.uuid4())
+    __slots__ = (
+        'id', 'client_ip',
+        'chunk_size', 'out_chunk_size', 'window_acknowledgement_size', 'peer_bandwidth',
+        'flashVer', 'tcUrl', 'swfUrl', 'app', 'objectEncoding',
+        'connection', 'recv_buf',
+        'lastWriteHeaders', 'nextChannelId', 'streams', '_time0_ns', 'stream_mode',
+        'streamPath', 'publishStreamId', 'publishStreamPath', 'CacheState', 'IncomingPackets', 'ExtIncomingPackets', 'lastPayloadCheck', 'Players',
+        'metaData', 'metaDataPayload', 'audioSampleRate', 'audioChannels', 'videoWidth', 'videoHeight', 'videoFps', 'Bitrate',
+        'isFirstAudioReceived', 'isReceiveVideo', 'aacSequenceHeader', 'avcSequenceHeader',
+        'audioCodec', 'audioCodecName', 'audioProfileName', 'videoCodec', 'videoCodecName', 'videoProfileName', 'videoCount', 'videoLevel',
+        'inAckSize', 'inLastAck',
+    )
+
+    # Never changed per connection
+    connectType = 'nonprivate'
+
+    def __init__(self, client_id=0):
+        self.id = client_id
         self.client_ip = '0.0.0.0'
 
         # RTMP properties
         self.chunk_size = 128  # Default chunk size
-        self.out_chunk_size = 4096 # Default out chunk size
+        self.out_chunk_size = OUT_CHUNK_SIZE # Default out chunk size
         self.window_acknowledgement_size = 5000000  # Default window acknowledgement size
         self.peer_bandwidth = 0  # Default peer bandwidth
 
         # RTMP Invoke Connect Data
         self.flashVer = 'FMLE/3.0 (compatible; FMSc/1.0)'
-        self.connectType = 'nonprivate'
         self.tcUrl = ''
         self.swfUrl = ''
         self.app = ''
         self.objectEncoding = 0
 
-        self.reader: Optional[asyncio.StreamReader] = None
-        self.writer: Optional[asyncio.StreamWriter] = None
+        self.connection: Optional[RTMPConnection] = None
+        self.recv_buf = bytearray(18)  # Receive buffer for chunk headers (3 byte basic header + 11 byte message header + 4 byte extended timestamp)
         
         self.lastWriteHeaders = dict()
         self.nextChannelId = PROTOCOL_CHANNEL_ID + 1
         self.streams = 0
-        self._time0 = time.time()
+        self._time0_ns = time.monotonic_ns()
         self.stream_mode = None
         
         self.streamPath = ''
         self.publishStreamId = 0
         self.publishStreamPath = ''
         self.CacheState = 0
-        self.IncomingPackets = {}
+        self.IncomingPackets = [None] * 64  # Packets being received, indexed by chunk stream id (1 byte basic header ids)
+        self.ExtIncomingPackets = {}  # Packets on chunk stream ids 64-65599 (2 and 3 byte basic headers)
+        self.lastPayloadCheck = 0
         self.Players = {}
 
         # Meta Data
@@ -130,6 +245,149 @@ class ClientState:
         self.inAckSize = 0
         self.inLastAck = 0
 
+# Socket protocol of a client connection. The socket is read straight into a preallocated receive buffer,
+# which the chunk reader consumes in place; it also exposes the few writer calls the server uses
+class RTMPConnection(asyncio.BufferedProtocol):
+    def __init__(self, server, limit=ReadBufferLimit, buffer_size=RecvBufferSize):
+        self.server = server
+        self.limit = limit
+        self.transport = None
+        self.task = None
+        self.buffer = bytearray(buffer_size)
+        self.start = 0  # Received bytes not consumed yet are buffer[start:end]
+        self.end = 0
+        self.eof = False
+        self.exception = None
+        self.read_paused = False
+        self.write_paused = False
+        self.read_waiter = None
+        self.drain_waiter = None
+        self.closed = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        loop = asyncio.get_running_loop()
+        self.closed = loop.create_future()
+        self.task = loop.create_task(self.server.handle_client(self))
+
+    def get_buffer(self, sizehint):
+        buffered = self.end - self.start
+        if buffered == 0:
+            self.start = self.end = 0
+            if len(self.buffer) > RecvBufferSize:
+                # Drained after a burst, give the grown buffer back
+                self.buffer = bytearray(RecvBufferSize)
+        elif len(self.buffer) - self.end < RecvBufferMinFree:
+            if buffered + RecvBufferMinFree > len(self.buffer):
+                # Not enough room even after compacting, move to a bigger buffer
+                buffer = bytearray(max(2 * len(self.buffer), buffered + RecvBufferMinFree))
+                buffer[:buffered] = memoryview(self.buffer)[self.start:self.end]
+                self.buffer = buffer
+            else:
+                # Move the unconsumed bytes to the front
+                with memoryview(self.buffer) as view:
+                    view[:buffered] = view[self.start:self.end]
+            self.start, self.end = 0, buffered
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        self._wakeup(self.read_waiter)
+        if not self.read_paused and self.end - self.start > self.limit:
+            self.transport.pause_reading()
+            self.read_paused = True
+
+    def eof_received(self):
+        self.eof = True
+        self._wakeup(self.read_waiter)
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.exception = exc
+        self._wakeup(self.read_waiter)
+        self._wakeup(self.drain_waiter)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        self._wakeup(self.drain_waiter)
+
+    def _wakeup(self, waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def _wait_for_data(self, n):
+        # Suspend until n bytes are buffered
+        while self.end - self.start < n:
+            if self.eof:
+                raise asyncio.IncompleteReadError(bytes(self.buffer[self.start:self.end]), n)
+            if self.read_paused:
+                self.read_paused = False
+                self.transport.resume_reading()
+            self.read_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.read_waiter
+            finally:
+                self.read_waiter = None
+
+    def _consume(self, n):
+        self.start += n
+        if self.read_paused and self.end - self.start <= self.limit:
+            self.read_paused = False
+            self.transport.resume_reading()
+
+    async def readexactly(self, n):
+        await self._wait_for_data(n)
+        # Slice through a view so the bytes are copied once, not via an intermediate bytearray
+        with memoryview(self.buffer) as buffered:
+            data = bytes(buffered[self.start:self.start + n])
+        self._consume(n)
+        return data
+
+    async def readinto(self, view):
+        # Fill the writable memoryview with exactly len(view) bytes
+        n = len(view)
+        await self._wait_for_data(n)
+        with memoryview(self.buffer) as buffered:
+            view[:] = buffered[self.start:self.start + n]
+        self._consume(n)
+
+    async def readappend(self, buffer, n):
+        # Append exactly n bytes to the bytearray, copying straight from the receive buffer
+        await self._wait_for_data(n)
+        with memoryview(self.buffer) as buffered:
+            buffer += buffered[self.start:self.start + n]
+        self._consume(n)
+
+    def write(self, data):
+        self.transport.write(data)
+
+    async def drain(self):
+        if self.transport.is_closing():
+            # Let connection_lost run before reporting the state of the connection
+            await asyncio.sleep(0)
+        if self.closed.done():
+            raise self.exception or ConnectionResetError('Connection lost')
+        if self.write_paused:
+            self.drain_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.drain_waiter
+            finally:
+                self.drain_waiter = None
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await self.closed
+
 # RTMP server class
 class RTMPServer:
     def __init__(self, host='0.0.0.0', port=1935):
@@ -138,171 +396,171 @@ class RTMPServer:
         self.host = host
         self.port = port
         self.client_states = {}
+        self.publisher_apps = {}  # Reverse index of LiveUsers: publisher client_id -> app
+        self.client_ids = itertools.count(1)  # Connection ids, unique per server
         
         self.logger = logging.getLogger('RTMPServer')
         self.logger.setLevel(LogLevel)
 
-    async def handle_client(self, reader, writer):
+        # Control messages for the values every client is sent, serialized once
+        self.prebuilt_window_ack = self.build_window_ack(WINDOW_ACKNOWLEDGEMENT_SIZE)
+        self.prebuilt_chunk_size = self.build_chunk_size(OUT_CHUNK_SIZE)
+        self.prebuilt_peer_bandwidth = self.build_peer_bandwidth(PEER_BANDWIDTH, PEER_BANDWIDTH_DYNAMIC)
+
+    async def handle_client(self, connection):
         # Create a new client state for each connected client
-        client_state = ClientState()
+        client_state = ClientState(next(self.client_ids))
         self.client_states[client_state.id] = client_state
-        self.client_states[client_state.id].clientID = client_state.id
 
-        self.client_states[client_state.id].reader = reader
-        self.client_states[client_state.id].writer = writer
+        client_state.connection = connection
 
-        self.client_states[client_state.id].client_ip  = writer.get_extra_info('peername')
-        self.logger.info("New client connected: %s", self.client_states[client_state.id].client_ip)
+        client_state.client_ip  = connection.get_extra_info('peername')
+        self.logger.info("New client connected: %s", client_state.client_ip)
 
         # Perform RTMP handshake
         try:
-            await asyncio.wait_for(self.perform_handshake(client_state.id), timeout=5)
+            async with asyncio.timeout(5):
+                await self.perform_handshake(client_state)
         except asyncio.TimeoutError:
-            self.logger.error("Handshake timeout. Closing connection: %s", self.client_states[client_state.id].client_ip)
-            await self.disconnect(client_state.id)
+            self.logger.error("Handshake timeout. Closing connection: %s", client_state.client_ip)
+            await self.disconnect(client_state)
             return
 
         # Process RTMP messages
         while True:
             try:
-                await self.get_chunk_data(client_state.id)
+                await self.get_chunk_data(client_state)
                 
             except asyncio.TimeoutError:
-                self.logger.debug("Connection timeout. Closing connection: %s", self.client_states[client_state.id].client_ip)
+                self.logger.debug("Connection timeout. Closing connection: %s", client_state.client_ip)
                 break
             
             except DisconnectClientException:
-                self.logger.debug("Disconnecting client: %s", self.client_states[client_state.id].client_ip)
+                self.logger.debug("Disconnecting client: %s", client_state.client_ip)
                 break
             
             except ConnectionAbortedError as e:
-                self.logger.debug("Connection aborted by client: %s", self.client_states[client_state.id].client_ip)
+                self.logger.debug("Connection aborted by client: %s", client_state.client_ip)
                 break
         
             except Exception as e:
                 self.logger.error("An error occurred: %s", str(e))
                 break
 
-        await self.disconnect(client_state.id)
+        await self.disconnect(client_state)
         
-    async def disconnect(self, client_id):
+    async def disconnect(self, client_state):
         # Close the client connection
-        client_state = self.client_states[client_id]
         if client_state.stream_mode == 'live':
             # Finish Stream for players!
             print("NEED DISCONNECT Players!")
 
         client_ip = client_state.client_ip
-        for app in LiveUsers:
-            if LiveUsers[app]['client_id'] == client_id:
-                del LiveUsers[app]
-                break
+        app = self.publisher_apps.pop(client_state.id, None)
+        if app is not None:
+            LiveUsers.pop(app, None)
 
-        client_state['IncomingPackets'].clear()
+        client_state.IncomingPackets.clear()
+        client_state.ExtIncomingPackets.clear()
 
-        del self.client_states[client_id]
+        del self.client_states[client_state.id]
         try:
-            client_state.writer.close()
-            await client_state.writer.wait_closed()
+            client_state.connection.close()
+            await client_state.connection.wait_closed()
             self.logger.info("Client disconnected: %s", client_ip)
         except Exception as e:
             # Handle the exception here, perform other tasks, or log the error.
-            self.logger.error(f"Error occurred while disconnecting client: {e}")
+            self.logger.error("Error occurred while disconnecting client: %s", e)
 
 
-    async def get_chunk_data(self, client_id):
+    async def get_chunk_data(self, client_state):
         # Read a chunk of data from the client
-        client_state = self.client_states[client_id]
         try:
-            chunk_data = await client_state.reader.readexactly(1)
-            if not chunk_data:
-                raise DisconnectClientException()
-            
-            cid = chunk_data[0] & 0b00111111
+            connection = client_state.connection
+            recv_buf = client_state.recv_buf
+            await connection.readinto(memoryview(recv_buf)[:1])
             
+            fmt = (recv_buf[0] & 0b11000000) >> 6
+            cid = recv_buf[0] & 0b00111111
+
             # Chunk Basic Header field may be 1, 2, or 3 bytes, depending on the chunk stream ID.
+            # The extra basic header bytes and the FMT 0, 1, 2 message header are fetched in a single read.
+            basic_size = 0
             if cid == 0: # ChunkBasicHeader: 2
-                chunk_data += await client_state.reader.readexactly(1) # Need read 1 more packet
-                cid = 64 + chunk_data[1] # Chunk stream IDs 64-319 can be encoded in the 2-byte form of the header
+                basic_size = 1
             elif cid == 1: #ChunkBasicHeader: 3
-                chunk_data += await client_state.reader.readexactly(2) # Need read 2 more packets
-                cid = (64 + chunk_data[1] + chunk_data[2]) << 8 # Chunk stream IDs 64-65599 can be encoded in the 3-byte version of this field
-
-            chunk_full = bytearray(chunk_data)
-            fmt = (chunk_data[0] & 0b11000000) >> 6
-
-            if not cid in client_state.IncomingPackets:
-                client_state.IncomingPackets[cid] = self.createPacket(cid, fmt)
+                basic_size = 2
+            header_size = basic_size + CHUNK_MESSAGE_HEADER_SIZE[fmt]
+            header_data = memoryview(recv_buf)[1:1 + header_size]
+            if header_size:
+                await connection.readinto(header_data)
+            if cid == 0:
+                cid = 64 + header_data[0] # Chunk stream IDs 64-319 can be encoded in the 2-byte form of the header
+            elif cid == 1:
+                cid = 64 + header_data[0] + (header_data[1] << 8) # Chunk stream IDs 64-65599 can be encoded in the 3-byte version of this field, low byte first
+
+            if cid < 64:
+                packet = client_state.IncomingPackets[cid]
+                if packet is None:
+                    packet = client_state.IncomingPackets[cid] = self.createPacket(cid, fmt)
+            else:
+                packet = client_state.ExtIncomingPackets.get(cid)
+                if packet is None:
+                    packet = client_state.ExtIncomingPackets[cid] = self.createPacket(cid, fmt)
             
             # I'm afraid I suffer from memory leaks. :D
-            client_state.IncomingPackets[cid]['last_received_time'] = time.time()
-            self.clearPayloadIfTimeout(client_id, 120)
+            packet.last_received_time = time.monotonic()
+            self.clearPayloadIfTimeout(client_state, 120)
 
-            header_data = bytearray()
-             # Get Message Timestamp for FMT 0, 1, 2
+            # Decode Message Header for FMT 0, 1, 2
             if fmt <= RTMP_CHUNK_TYPE_2:
-                timestamp_bytes = await client_state.reader.readexactly(3)
-                header_data += timestamp_bytes
-                client_state.IncomingPackets[cid]['timestamp'] = int.from_bytes(timestamp_bytes, byteorder='big')
-                del timestamp_bytes
-
-            # Get Message Length and Message Type for FMT 0, 1
-            if fmt <= RTMP_CHUNK_TYPE_1:
-                length_bytes = await client_state.reader.readexactly(3)
-                header_data += length_bytes
-                type_bytes = await client_state.reader.readexactly(1)
-                header_data += type_bytes
-                client_state.IncomingPackets[cid]['payload_length'] = int.from_bytes(length_bytes, byteorder='big')
-                client_state.IncomingPackets[cid]['msg_type_id'] = int.from_bytes(type_bytes, byteorder='big')
-                client_state.IncomingPackets[cid]['payload'] = bytearray()
-                del length_bytes
-                del type_bytes
-            
-            # Get Message Stream ID for FMT 0
-            if fmt == RTMP_CHUNK_TYPE_0: 
-                streamID_bytes = await client_state.reader.readexactly(4)
-                header_data += streamID_bytes
-                client_state.IncomingPackets[cid]['msg_stream_id'] = int.from_bytes(streamID_bytes, byteorder='big')
-                del streamID_bytes
+                parse_message_header(fmt, recv_buf, packet, 1 + basic_size)
             
-            chunk_full += header_data
+            client_state.inAckSize += 1 + header_size
             
             # Set Main Packet Headers and payload_length for FMT 0, 1
             if fmt <= RTMP_CHUNK_TYPE_1: 
-                # client_state.IncomingPackets[cid]['basic_header'] = chunk_data
-                # client_state.IncomingPackets[cid]['header'] = header_data
-                payload_length = client_state.IncomingPackets[cid]['payload_length']
+                payload_length = packet.header.length
 
             # Calculate Payload Remaining length for FMT 2,3 
             if fmt > RTMP_CHUNK_TYPE_1:
-                payload_length = client_state.IncomingPackets[cid]['payload_length'] - len(client_state.IncomingPackets[cid]['payload'])
+                payload_length = packet.header.length - packet.received
 
             # Check message type id
-            if RTMP_TYPE_METADATA < client_state.IncomingPackets[cid]['msg_type_id']:
-                self.logger.error("Invalid Packet Type: %s", str(client_state.IncomingPackets[cid]['msg_type_id']))
+            if RTMP_TYPE_METADATA < packet.header.type:
+                self.logger.error("Invalid Packet Type: %s", str(packet.header.type))
                 raise DisconnectClientException()
             
             # Messages with type=3 should never have ext timestamp field according to standard. However that's not always the case in real life
-            if client_state.IncomingPackets[cid]['timestamp'] == 0xffffff:  # Max Value check (16777215), Need to read extended timestamp
-                extended_timestamp_bytes = await client_state.reader.readexactly(4)
-                chunk_full += extended_timestamp_bytes
-                client_state.IncomingPackets[cid]['extended_timestamp'] = int.from_bytes(extended_timestamp_bytes, byteorder='big')
-                del extended_timestamp_bytes
+            if packet.header.timestamp == 0xffffff:  # Max Value check (16777215), Need to read extended timestamp
+                await connection.readinto(memoryview(recv_buf)[14:18])
+                client_state.inAckSize += 4
+                packet.extended_timestamp = _U32BE.unpack_from(recv_buf, 14)[0]
 
-            client_state.inAckSize += len(chunk_full)
-
-            self.logger.debug(f"FMT: {fmt}, CID: {cid}, Message Length: {payload_length}, Timestamp: {client_state.IncomingPackets[cid]['timestamp']}")
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("FMT: %s, CID: %s, Message Length: %s, Timestamp: %s", fmt, cid, payload_length, packet.header.timestamp)
 
             if payload_length > 0:
                 payload_length = min(client_state.chunk_size, payload_length)
-                payload = await client_state.reader.readexactly(payload_length)
-                client_state.inAckSize += len(payload)
-                client_state.IncomingPackets[cid]['payload'] += payload
-                del payload
+                if packet.received == 0:
+                    # First chunk of a message: FMT 0 carries an absolute timestamp, FMT 1, 2 and 3 a delta to the previous message of the chunk stream
+                    timestamp = packet.extended_timestamp if packet.header.timestamp == 0xffffff else packet.header.timestamp
+                    if fmt == RTMP_CHUNK_TYPE_0:
+                        packet.clock = timestamp
+                    else:
+                        packet.clock += timestamp
+                    # The payload grows only by the bytes actually received, never by the length the peer declares
+                    packet.payload = bytearray()
+                await connection.readappend(packet.payload, payload_length)
+                packet.received += payload_length
+                client_state.inAckSize += payload_length
             else:
                 # I'm not sure. In some cases, I may need to disconnect the client, while in other cases, I won't. I will ignore the issue and proceed to the next packet, but I will clear the payload. If invalid data continues, it may result in a disconnection when processing subsequent packets.
-                self.logger.error(f"Invalid Length (ZERO!), FMT: {fmt}, CID: {cid}, Message Length: {payload_length}, Timestamp: {client_state.IncomingPackets[cid]['timestamp']}")
-                client_state.IncomingPackets[cid]['payload'] = bytearray()
+                self.logger.error("Invalid Length (ZERO!), FMT: %s, CID: %s, Message Length: %s, Timestamp: %s", fmt, cid, payload_length, packet.header.timestamp)
+                packet.payload = bytearray()
+                packet.received = 0
+                # Yield to other clients so a stream of empty chunks cannot monopolize the loop
+                await asyncio.sleep(0)
                 return
                 
             if client_state.inAckSize >= 0xF0000000:
@@ -310,138 +568,98 @@ class RTMPServer:
                 client_state.inLastAck = 0
             
             # Delete some variables for fun!
-            del chunk_data
-            del chunk_full
             del payload_length
             del header_data
 
-            if len(client_state.IncomingPackets[cid]['payload']) >= client_state.IncomingPackets[cid]['payload_length']:
-                rtmp_packet = {
-                    "header": {
-                        "fmt": client_state.IncomingPackets[cid]["fmt"],
-                        "cid": client_state.IncomingPackets[cid]["cid"],
-                        "timestamp": client_state.IncomingPackets[cid]["timestamp"],
-                        "length": client_state.IncomingPackets[cid]["payload_length"],
-                        "type": client_state.IncomingPackets[cid]["msg_type_id"],
-                        "stream_id": client_state.IncomingPackets[cid]["msg_stream_id"]
-                    },
-                    "clock": 0,
-                    "payload": client_state.IncomingPackets[cid]['payload']
-                }
-                client_state.IncomingPackets[cid]['payload'] = bytearray()
-                await self.handle_rtmp_packet(client_id, rtmp_packet)
+            if packet.received >= packet.header.length:
+                header = packet.header
+                rtmp_packet = RTMPPacket(
+                    RTMPHeader(header.fmt, header.cid, header.timestamp, header.length, header.type, header.stream_id),
+                    packet.payload, packet.clock)
+                packet.payload = bytearray()
+                packet.received = 0
+                await self.handle_rtmp_packet(client_state, rtmp_packet)
                 del rtmp_packet
 
             # Send ACK If needed!
             if(client_state.window_acknowledgement_size > 0 and client_state.inAckSize - client_state.inLastAck >= client_state.window_acknowledgement_size):
                 client_state.inLastAck = client_state.inAckSize
-                await self.send_ack(client_id, client_state.inAckSize)
+                await self.send_ack(client_state, client_state.inAckSize)
 
+        except DisconnectClientException:
+            raise
         except Exception as e:
             self.logger.error("An error occurred: %s", str(e))
             raise DisconnectClientException()
 
     # This function is designed to safely stop memory leaks if they exist. It ensures that memory is properly managed and prevents any potential leaks from causing issues.
-    def clearPayloadIfTimeout(self, client_id, packet_timeout=30):
-        client_state = self.client_states[client_id]
-        current_time = time.time()
-        for cid, packet in client_state.IncomingPackets.items():
-            if 'last_received_time' in packet and current_time - packet['last_received_time'] >= packet_timeout:
-                packet['payload'] = bytearray()  # Clear the payload
+    def clearPayloadIfTimeout(self, client_state, packet_timeout=30):
+        current_time = time.monotonic()
+        # Timeouts are in the order of minutes, sweeping once a second is plenty
+        if current_time - client_state.lastPayloadCheck < 1:
+            return
+        client_state.lastPayloadCheck = current_time
+        for packet in itertools.chain(client_state.IncomingPackets, client_state.ExtIncomingPackets.values()):
+            if packet is not None and current_time - packet.last_received_time >= packet_timeout:
+                packet.payload = bytearray()  # Clear the payload
+                packet.received = 0
 
     def createPacket(self, cid, fmt):
-        out = {}
-        out['fmt'] = fmt
-        out['cid'] = cid
-        # out['basic_header'] = bytearray()
-        # out['header'] = bytearray()
-
-        out['timestamp'] = 0
-        out['extended_timestamp'] = 0
-        out['payload_length'] = 0
-        out['msg_type_id'] = 0
-        out['msg_stream_id'] = 0
-        out['payload'] = bytearray()
-        out['last_received_time'] = time.time()
-
-        return out
-
-    async def perform_handshake(self, client_id):
+        return RTMPPacket(RTMPHeader(fmt, cid))
+
+    async def perform_handshake(self, client_state):
         # Perform the RTMP handshake with the client
-        client_state = self.client_states[client_id]
         
-        c0_data = await client_state.reader.readexactly(1)
+        c0_data = await client_state.connection.readexactly(1)
         if c0_data != bytes([0x03]) and c0_data != bytes([0x06]):
-            client_state.writer.close()
-            await client_state.writer.wait_closed()
-            self.logger.info("Invalid Handshake, Client disconnected: %s", self.client_ip)
+            client_state.connection.close()
+            await client_state.connection.wait_closed()
+            self.logger.info("Invalid Handshake, Client disconnected: %s", client_state.client_ip)
 
-        c1_data = await client_state.reader.readexactly(1536)
+        c1_data = await client_state.connection.readexactly(1536)
         clientType = bytes([3])
         messageFormat = handshake.detectClientMessageFormat(c1_data)
         if messageFormat == handshake.MESSAGE_FORMAT_0:
-            await self.send(client_id, clientType)
             s1_data = c1_data
             s2_data = c1_data
-            await self.send(client_id, c1_data)
-            await client_state.reader.readexactly(len(s1_data))
-            await self.send(client_id, s2_data)
         else:
             s1_data = handshake.generateS1(messageFormat)
             s2_data = handshake.generateS2(messageFormat, c1_data)
-            data = clientType + s1_data + s2_data
-            client_state.writer.write(data)
-            s1_data = await client_state.reader.readexactly(len(s1_data))
+        # S2 only depends on C1, so S0, S1 and S2 go out in a single write
+        self.send(client_state, clientType + s1_data + s2_data)
+        await self.flush(client_state)
+        await client_state.connection.readexactly(len(s1_data))
 
         self.logger.debug("Handshake done!")
 
-    async def handle_rtmp_packet(self, client_id, rtmp_packet):
+    async def handle_rtmp_packet(self, client_state, rtmp_packet):
         # Handle an RTMP packet from the client
-        # client_state = self.client_states[client_id]
 
         # Extract information from rtmp_packet and process as needed
-        msg_type_id = rtmp_packet["header"]["type"]
-        payload = rtmp_packet["payload"]
+        msg_type_id = rtmp_packet.header.type
         # self.logger.debug("Received RTMP packet:")
         # self.logger.debug("  RTMP Packet Type: %s", msg_type_id)
-    
-        if msg_type_id == RTMP_TYPE_SET_CHUNK_SIZE:
-            self.handle_chunk_size_message(client_id, payload)
-        elif msg_type_id == RTMP_TYPE_ACKNOWLEDGEMENT:
-            await self.handle_bytes_read_report(client_id, payload)
-        # elif msg_type_id == RTMP_PACKET_TYPE_CONTROL:
-        #     self.handle_control_message(payload)
-        elif msg_type_id == RTMP_TYPE_WINDOW_ACKNOWLEDGEMENT_SIZE:
-            self.handle_window_acknowledgement_size(client_id, payload)
-        elif msg_type_id == RTMP_TYPE_SET_PEER_BANDWIDTH:
-            self.handle_set_peer_bandwidth(client_id, payload)
-        elif msg_type_id == RTMP_TYPE_AUDIO:
-            await self.handle_audio_data(client_id, rtmp_packet)
-        elif msg_type_id == RTMP_TYPE_VIDEO:
-            await self.handle_video_data(client_id, rtmp_packet)
-        # elif msg_type_id == RTMP_TYPE_FLEX_STREAM:
-        #     self.handle_flex_stream_message(payload)
-        # elif msg_type_id == RTMP_TYPE_FLEX_OBJECT:
-        #     self.handle_flex_shared_object_message(payload)
-        elif msg_type_id == RTMP_TYPE_FLEX_MESSAGE:
-            invoke_message = self.parse_amf0_invoke_message(rtmp_packet)
-            await self.handle_invoke_message(client_id, invoke_message)
-        elif msg_type_id == RTMP_TYPE_DATA:
-            await self.handle_amf_data(client_id, rtmp_packet)
-        # elif msg_type_id == RTMP_TYPE_SHARED_OBJECT:
-        #     self.handle_amf0_shared_object_message(payload)
-        elif msg_type_id == RTMP_TYPE_INVOKE:
-            invoke_message = self.parse_amf0_invoke_message(rtmp_packet)
-            await self.handle_invoke_message(client_id, invoke_message)
-        # elif msg_type_id == RTMP_TYPE_METADATA:
-        #     self.handle_metadata_message(payload)
-        else:
-            self.logger.debug("Unsupported RTMP packet type: %s", msg_type_id)
 
-    async def handle_video_data(self, client_id, rtmp_packet):
+        handler = self.PACKET_HANDLERS.get(msg_type_id)
+        if handler is not None:
+            await handler(self, client_state, rtmp_packet)
+            return
+
+        handler = self.CONTROL_HANDLERS.get(msg_type_id)
+        if handler is not None:
+            handler(self, client_state, rtmp_packet)
+            return
+
+        # RTMP_PACKET_TYPE_CONTROL, RTMP_TYPE_FLEX_STREAM, RTMP_TYPE_FLEX_OBJECT, RTMP_TYPE_SHARED_OBJECT and RTMP_TYPE_METADATA are not handled yet
+        self.logger.debug("Unsupported RTMP packet type: %s", msg_type_id)
+
+    async def handle_invoke_packet(self, client_state, rtmp_packet):
+        invoke_message = self.parse_amf0_invoke_message(rtmp_packet)
+        await self.handle_invoke_message(client_state, invoke_message)
+
+    async def handle_video_data(self, client_state, rtmp_packet):
         # Handle video data in an RTMP packet
-        client_state = self.client_states[client_id]
-        payload = rtmp_packet['payload']
+        payload = rtmp_packet.payload
         isExHeader = (payload[0] >> 4 & 0b1000) != 0
         frame_type = payload[0] >> 4 & 0b0111
         codec_id = payload[0] & 0x0f
@@ -499,13 +717,9 @@ class RTMPServer:
             self.logger.info("Codec Name: %s", client_state.videoCodecName)
 
         
-    async def handle_audio_data(self, client_id, rtmp_packet):
-        client_state = self.client_states[client_id]
-        payload = rtmp_packet['payload']
-        sound_format = (payload[0] >> 4) & 0x0f
-        sound_type = payload[0] & 0x01
-        sound_size = (payload[0] >> 1) & 0x01
-        sound_rate = (payload[0] >> 2) & 0x03
+    async def handle_audio_data(self, client_state, rtmp_packet):
+        payload = rtmp_packet.payload
+        sound_format, sound_type, sound_size, sound_rate = av.AUDIO_TAG_HEADER[payload[0]]
 
         if client_state.audioCodec == 0:
             client_state.audioCodec = sound_format;
@@ -543,56 +757,42 @@ class RTMPServer:
         #write for players
 
 
-    def handle_chunk_size_message(self, client_id, payload):
+    def handle_chunk_size_message(self, client_state, rtmp_packet):
         # Handle Chunk Size message
-        new_chunk_size = int.from_bytes(payload, byteorder='big')
+        new_chunk_size, = _U32BE.unpack_from(rtmp_packet.payload)
         if(MAX_CHUNK_SIZE < new_chunk_size):
-            self.logger.debug("Chunk size is too big!", new_chunk_size)
+            self.logger.debug("Chunk size is too big! %d", new_chunk_size)
             raise DisconnectClientException()
         
-        self.client_states[client_id].chunk_size = new_chunk_size
-        self.logger.debug("Updated chunk size: %d", self.client_states[client_id].chunk_size)
+        client_state.chunk_size = new_chunk_size
+        self.logger.debug("Updated chunk size: %d", client_state.chunk_size)
 
-    def handle_window_acknowledgement_size(self, client_id, payload):
+    def handle_window_acknowledgement_size(self, client_state, rtmp_packet):
         # Handle Window Acknowledgement Size message
-        client_state = self.client_states[client_id]
-        new_window_acknowledgement_size = int.from_bytes(payload, byteorder='big')
-        client_state.window_acknowledgement_size = new_window_acknowledgement_size
+        client_state.window_acknowledgement_size, = _U32BE.unpack_from(rtmp_packet.payload)
         self.logger.debug("Updated window acknowledgement size: %d", client_state.window_acknowledgement_size)
 
-    def handle_set_peer_bandwidth(self, client_id, payload):
+    def handle_set_peer_bandwidth(self, client_state, rtmp_packet):
         # Handle Set Peer Bandwidth message
-        client_state = self.client_states[client_id]
-        bandwidth = int.from_bytes(payload[:4], byteorder='big')
-        limit_type = payload[4]
-        client_state.peer_bandwidth = bandwidth
+        client_state.peer_bandwidth, limit_type = _U32BE_U8.unpack_from(rtmp_packet.payload)
         self.logger.debug("Updated peer bandwidth: %d, Limit type: %d", client_state.peer_bandwidth, limit_type)
 
-    async def handle_invoke_message(self, client_id, invoke):
-        if invoke['cmd'] == 'connect':
-            self.logger.debug("Received connect invoke")
-            await self.handle_connect_command(client_id, invoke)
-        elif invoke['cmd'] == 'releaseStream' or invoke['cmd'] == 'FCPublish'or invoke['cmd'] == 'FCUnpublish' or invoke['cmd'] == 'getStreamLength':
-            self.logger.debug("Received %s invoke", invoke['cmd'])
-            return
-        elif invoke['cmd'] == 'createStream':
-            self.logger.debug("Received createStream invoke")
-            await self.response_createStream(client_id, invoke)
-        elif invoke['cmd'] == 'publish':
-            self.logger.debug("Received publish invoke")
-            await self.handle_publish(client_id, invoke)
-        elif invoke['cmd'] == 'play':
-            self.logger.debug("Received play invoke")
-            await self.handle_onPlay(client_id, invoke)
+    async def handle_invoke_message(self, client_state, invoke):
+        cmd = invoke['cmd']
+        handler = self.INVOKE_HANDLERS.get(cmd)
+        if handler is not None:
+            self.logger.debug("Received %s invoke", cmd)
+            await handler(self, client_state, invoke)
+        elif cmd in _IGNORED_COMMANDS:
+            self.logger.debug("Received %s invoke", cmd)
         # Need to add and support other CMDs.
         else:
-            self.logger.info("Unsupported invoke command %s!", invoke['cmd'])
+            self.logger.debug("Unsupported invoke command %s!", cmd)
     
-    async def handle_onPlay(self, client_id, invoke):
-        client_state = self.client_states[client_id]
+    async def handle_onPlay(self, client_state, invoke):
         if not client_state.app in LiveUsers:
             self.logger.warning("Stream not exists to play!")
-            await self.sendStatusMessage(client_id, client_state.publishStreamId, "error", "NetStream.Play.BadName", "Stream not exists")
+            await self.sendStatusMessage(client_state, client_state.publishStreamId, "error", "NetStream.Play.BadName", "Stream not exists")
             raise DisconnectClientException()
         
         publisher_id = LiveUsers[client_state.app]['client_id']
@@ -605,134 +805,121 @@ class RTMPServer:
             amfWriter.write(publisher_client_state.metaData)
             output.seek(0)
             payload = output.read()
-            streamId = invoke['packet']['header']['stream_id']
+            streamId = invoke['packet'].header.stream_id
             packet_header = common.Header(RTMP_CHANNEL_DATA, 0, len(payload), RTMP_TYPE_DATA, streamId)
             response = common.Message(packet_header, payload)
-            await self.writeMessage(client_id, response)
+            await self.writeMessage(client_state, response)
 
-    async def handle_publish(self, client_id, invoke):
-        client_state = self.client_states[client_id]
+    async def handle_publish(self, client_state, invoke):
         client_state.stream_mode = 'live' if len(invoke['args']) < 2 else invoke['args'][1]  # live, record, append
         client_state.streamPath = invoke['args'][0]
-        client_state.publishStreamId = int(invoke['packet']['header']['stream_id'])
+        client_state.publishStreamId = int(invoke['packet'].header.stream_id)
         client_state.publishStreamPath = "/" + client_state.app + "/" + client_state.streamPath.split("?")[0]
         if(client_state.streamPath == None or client_state.streamPath == ''):
             self.logger.warning("Stream key is empty!")
-            await self.sendStatusMessage(client_id, client_state.publishStreamId, "error", "NetStream.publish.Unauthorized", "Authorization required.")
+            await self.sendStatusMessage(client_state, client_state.publishStreamId, "error", "NetStream.publish.Unauthorized", "Authorization required.")
             raise DisconnectClientException()
         
         if client_state.stream_mode == 'live':
             if LiveUsers.get(client_state.app) is not None:
                 self.logger.warning("Stream already publishing!")
-                await self.sendStatusMessage(client_id, client_state.publishStreamId, "error", "NetStream.Publish.BadName", "Stream already publishing")
+                await self.sendStatusMessage(client_state, client_state.publishStreamId, "error", "NetStream.Publish.BadName", "Stream already publishing")
                 raise DisconnectClientException()
         
             LiveUsers[client_state.app] = {
-                'client_id': client_id,
+                'client_id': client_state.id,
                 'stream_mode': client_state.stream_mode,
                 'stream_path': client_state.streamPath,
                 'publish_stream_id': client_state.publishStreamId,
                 'app': client_state.app,
             }
+            self.publisher_apps[client_state.id] = client_state.app
 
         self.logger.info("Publish Request Mode: %s, App: %s, Path: %s, publishStreamPath: %s, StreamID: %s", client_state.stream_mode, client_state.app, client_state.streamPath, client_state.publishStreamPath, str(client_state.publishStreamId))
-        await self.sendStatusMessage(client_id, client_state.publishStreamId, "status", "NetStream.Publish.Start", f"{client_state.publishStreamPath} is now published.")
-
-    async def sendStatusMessage(self, client_id, sid, level, code, description):
-        response = common.Command(
-        name='onStatus',
-        id=sid,
-        tm=self.relativeTime(client_id),
-        args=[
-            amf.Object(
-                level=level,
-                code=code,
-                description=description,
-                details=None)])
-        
-        message = response.toMessage()
+        await self.sendStatusMessage(client_state, client_state.publishStreamId, "status", "NetStream.Publish.Start", f"{client_state.publishStreamPath} is now published.")
+
+    async def sendStatusMessage(self, client_state, sid, level, code, description):
+        # onStatus(id, null, {level, code, description, details: null}) built from a template
+        data = bytearray(_ON_STATUS)
+        _DOUBLE.pack_into(data, _ON_STATUS_ID_OFFSET, sid)
+        data += b'\x00\x05level' + _amf0_string(level)
+        data += b'\x00\x04code' + _amf0_string(code)
+        data += b'\x00\x0bdescription' + _amf0_string(description)
+        data += b'\x00\x07details\x05'
+        data += b'\x00\x00\x09'  # object end
+
+        message = common.Message(common.Header(time=self.relativeTime(client_state), type=common.Message.RPC), bytes(data))
         self.logger.debug("Sending onStatus response!")
-        await self.writeMessage(client_id, message)
+        await self.writeMessage(client_state, message)
         
-    async def response_createStream(self, client_id, invoke):
-        client_state = self.client_states[client_id]
+    async def response_createStream(self, client_state, invoke):
         client_state.streams = client_state.streams + 1;
-        response = common.Command(
-            name='_result',
-            id=invoke['id'],
-            tm=self.relativeTime(client_id),
-            type=common.Message.RPC,
-            args=[client_state.streams])
+        data = bytearray(_CREATE_STREAM_RESULT)
+        _DOUBLE.pack_into(data, _CREATE_STREAM_RESULT_ID_OFFSET, invoke['id'])
+        _DOUBLE.pack_into(data, _CREATE_STREAM_RESULT_STREAM_OFFSET, client_state.streams)
 
-        message = response.toMessage()
+        message = common.Message(common.Header(time=self.relativeTime(client_state), type=common.Message.RPC), bytes(data))
         self.logger.debug("Sending createStream response!")
-        await self.writeMessage(client_id, message)
+        await self.writeMessage(client_state, message)
 
-    async def handle_connect_command(self, client_id, invoke):
-        client_state = self.client_states[client_id]
-        if hasattr(invoke['cmdData'], 'app'):
-            client_state.app = invoke['cmdData'].app
+    async def handle_connect_command(self, client_state, invoke):
+        cmdData = invoke['cmdData']
+        client_state.app = getattr(cmdData, 'app', client_state.app)
 
         if client_state.app == '':
             self.logger.warning("Empty 'app' attribute. Disconnecting client: %s", client_state.client_ip)
             raise DisconnectClientException()
         
-        if hasattr(invoke['cmdData'], 'tcUrl'):
-            client_state.tcUrl = invoke['cmdData'].tcUrl
-
-        if hasattr(invoke['cmdData'], 'swfUrl'):
-            client_state.swfUrl = invoke['cmdData'].swfUrl
-
-        if hasattr(invoke['cmdData'], 'flashVer'):
-            client_state.flashVer = invoke['cmdData'].flashVer
-
-        if hasattr(invoke['cmdData'], 'objectEncoding'):
-            client_state.objectEncoding = invoke['cmdData'].objectEncoding
+        client_state.tcUrl = getattr(cmdData, 'tcUrl', client_state.tcUrl)
+        client_state.swfUrl = getattr(cmdData, 'swfUrl', client_state.swfUrl)
+        client_state.flashVer = getattr(cmdData, 'flashVer', client_state.flashVer)
+        client_state.objectEncoding = getattr(cmdData, 'objectEncoding', client_state.objectEncoding)
 
         self.logger.info("App: %s, tcUrl: %s, swfUrl: %s, flashVer: %s", client_state.app, client_state.tcUrl, client_state.swfUrl, client_state.flashVer)
         
-        await self.send_window_ack(client_id, 5000000)
-        await self.set_chunk_size(client_id, client_state.out_chunk_size)
-        await self.set_peer_bandwidth(client_id, 5000000, 2)
-        await self.respond_connect(client_id, invoke['id'])
-
-    async def send(self, client_id, data):
-        client_state = self.client_states[client_id]
-        # Perform asynchronous sending operation
+        # Send the connect response sequence as a single write
+        data = bytearray(self.prebuilt_window_ack)
+        data += self.chunk_size_message(client_state.out_chunk_size)
+        data += self.prebuilt_peer_bandwidth
+        data += self.build_connect_response(client_state, invoke['id'])
+        self.send(client_state, data)
+        await self.flush(client_state)
+        self.logger.debug("Sent connect response sequence!")
+
+    def send(self, client_state, data):
+        # Queue data on the transport, flush() waits for it to drain
         # self.logger.info("Sending data: %s", data)
-        client_state.writer.write(data)
-        await client_state.writer.drain()
-
-
-    async def send_window_ack(self, client_id, size):
-        rtmp_buffer = bytes.fromhex("02000000000004050000000000000000")
-        rtmp_buffer = bytearray(rtmp_buffer)
-        rtmp_buffer[12:16] = size.to_bytes(4, byteorder='big')
-        await self.send(client_id, rtmp_buffer)
-        self.logger.debug("Set ack to %s", size)
-
-    async def send_ack(self, client_id, size):
-        rtmp_buffer = bytes.fromhex("02000000000004030000000000000000")
-        rtmp_buffer = bytearray(rtmp_buffer)
-        rtmp_buffer[12:16] = size.to_bytes(4, byteorder='big')
-        await self.send(client_id, rtmp_buffer)
+        client_state.connection.write(data)
+
+    async def flush(self, client_state):
+        # Wait for the transport to drain only when enough output is queued (or it is closing, to surface the error)
+        connection = client_state.connection
+        transport = connection.transport
+        if transport.is_closing() or transport.get_write_buffer_size() > WriteBufferHighWater:
+            await connection.drain()
+
+
+    def build_window_ack(self, size):
+        return _CONTROL_MESSAGE.pack(_WINDOW_ACK_HEADER, size)
+
+    async def send_ack(self, client_state, size):
+        self.send(client_state, _CONTROL_MESSAGE.pack(_ACK_HEADER, size))
+        await self.flush(client_state)
         self.logger.debug("Send ACK: %s", size)
 
-    async def set_peer_bandwidth(self, client_id, size, bandwidth_type):
-        rtmp_buffer = bytes.fromhex("0200000000000506000000000000000000")
-        rtmp_buffer = bytearray(rtmp_buffer)
-        rtmp_buffer[12:16] = size.to_bytes(4, byteorder='big')
-        rtmp_buffer[16] = bandwidth_type
-        await self.send(client_id, rtmp_buffer)
-        self.logger.debug("Set bandwidth to %s", size)
-
-    async def set_chunk_size(self, client_id, out_chunk_size):
-        rtmp_buffer = bytearray.fromhex("02000000000004010000000000000000")
-        struct.pack_into('>I', rtmp_buffer, 12, out_chunk_size)
-        await self.send(client_id, bytes(rtmp_buffer))
-        self.logger.debug("Set out chunk to %s", out_chunk_size)
-
-    async def handle_bytes_read_report(self, client_id, payload):
+    def build_peer_bandwidth(self, size, bandwidth_type):
+        return _CONTROL_MESSAGE_U8.pack(_PEER_BANDWIDTH_HEADER, size, bandwidth_type)
+
+    def build_chunk_size(self, out_chunk_size):
+        return _CONTROL_MESSAGE.pack(_CHUNK_SIZE_HEADER, out_chunk_size)
+
+    def chunk_size_message(self, out_chunk_size):
+        # The default chunk size is sent to nearly every client, reuse its prebuilt message
+        if out_chunk_size == OUT_CHUNK_SIZE:
+            return self.prebuilt_chunk_size
+        return self.build_chunk_size(out_chunk_size)
+
+    async def handle_bytes_read_report(self, client_state, rtmp_packet):
         # bytes_read = int.from_bytes(payload, byteorder='big')
         # self.logger.debug("Bytes read: %d", bytes_read)
         # # send ACK
@@ -742,8 +929,7 @@ class RTMPServer:
         # Just Ignore!
         return False
         
-    async def respond_connect(self, client_id, tid):
-        client_state = self.client_states[client_id]
+    def build_connect_response(self, client_state, tid):
         response = common.Command()
         response.id, response.name, response.type = tid, '_result', common.Message.RPC
 
@@ -757,21 +943,21 @@ class RTMPServer:
         
         response.setArg(arg)
         message = response.toMessage()
-        self.logger.debug("Sending connect response!")
-        await self.writeMessage(client_id, message)
+        return self.buildMessage(client_state, message)
 
-    async def writeMessage(self, client_id, message):
-        client_state = self.client_states[client_id]
-        if message.streamId in client_state.lastWriteHeaders:
-            header = client_state.lastWriteHeaders[message.streamId]
-        else:
-            if client_state.nextChannelId <= PROTOCOL_CHANNEL_ID:
-                client_state.nextChannelId = PROTOCOL_CHANNEL_ID + 1
-            header, client_state.nextChannelId = common.Header(
-                client_state.nextChannelId), client_state.nextChannelId + 1
-            client_state.lastWriteHeaders[message.streamId] = header
+    def buildMessage(self, client_state, message):
         if message.type < message.AUDIO:
+            # Protocol control messages always go on the protocol channel, with a full header
             header = common.Header(PROTOCOL_CHANNEL_ID)
+        else:
+            # Stream ids come from the peer and can be sparse, so this stays a dict, looked up once
+            header = client_state.lastWriteHeaders.get(message.streamId)
+            if header is None:
+                if client_state.nextChannelId <= PROTOCOL_CHANNEL_ID:
+                    client_state.nextChannelId = PROTOCOL_CHANNEL_ID + 1
+                header, client_state.nextChannelId = common.Header(
+                    client_state.nextChannelId), client_state.nextChannelId + 1
+                client_state.lastWriteHeaders[message.streamId] = header
         
         # now figure out the header data bytes
         if header.streamId != message.streamId or header.time == 0 or message.time <= header.time:
@@ -792,28 +978,46 @@ class RTMPServer:
             size=header.size,
             type=header.type,
             streamId=header.streamId)
-        assert message.size == len(message.data)
-        data = b''
-        while len(message.data) > 0:
-            data = data + hdr.toBytes(control)  # gather header bytes
-            count = min(client_state.out_chunk_size, len(message.data))
-            data = data + message.data[:count]
-            message.data = message.data[count:]
-            control = common.Header.SEPARATOR  # incomplete message continuation
+        payload = memoryview(message.data)
+        size = len(payload)
+        if size == 0:
+            return bytearray()
+        chunk_size = client_state.out_chunk_size
+        chunk_header = hdr.toBytes(control)  # gather header bytes
+        separator = hdr.toBytes(common.Header.SEPARATOR) if size > chunk_size else b''  # incomplete message continuation
+        # The wire size is known up front, so the output is allocated once and filled in place
+        chunks = (size + chunk_size - 1) // chunk_size
+        data = bytearray(len(chunk_header) + size + (chunks - 1) * len(separator))
+        with memoryview(data) as out:
+            pos = offset = 0
+            while offset < size:
+                out[pos:pos + len(chunk_header)] = chunk_header
+                pos += len(chunk_header)
+                count = min(chunk_size, size - offset)
+                out[pos:pos + count] = payload[offset:offset + count]
+                pos += count
+                offset += count
+                chunk_header = separator
+        return data
+
+    async def writeMessage(self, client_state, message):
+        data = self.buildMessage(client_state, message)
         try:
-            await self.send(client_id, data)
+            self.send(client_state, data)
+            await self.flush(client_state)
             self.logger.debug("Message sent!")
-        except:
-            self.logger.debug("Error on sending message!")
-
-    async def handle_amf_data(self, client_id, rtmp_packet):
-        client_state = self.client_states[client_id]
-        offset = 1 if rtmp_packet['header']['type'] == RTMP_TYPE_FLEX_MESSAGE else 0
-        payload = rtmp_packet['payload'][offset:rtmp_packet['header']['length']]
+        except ConnectionError as e:
+            # The peer is gone, stop handling this client instead of queueing more output
+            self.logger.debug("Error on sending message: %s", e)
+            raise DisconnectClientException() from e
+
+    async def handle_amf_data(self, client_state, rtmp_packet):
+        offset = 1 if rtmp_packet.header.type == RTMP_TYPE_FLEX_MESSAGE else 0
+        payload = memoryview(rtmp_packet.payload)[offset:rtmp_packet.header.length]
         amfReader = amf.AMF0(payload)
         inst = {}
-        inst['type'] = rtmp_packet['header']['type']
-        inst['time'] = rtmp_packet['header']['timestamp']
+        inst['type'] = rtmp_packet.header.type
+        inst['time'] = rtmp_packet.clock
         inst['packet'] = rtmp_packet
         inst['cmd'] = amfReader.read()  # first field is command name
         if inst['cmd'] == '@setDataFrame':
@@ -823,54 +1027,64 @@ class RTMPServer:
                 return
             
             inst['dataObj'] = amfReader.read()  # third is obj data
-            if(inst['dataObj'] != None):
-                    self.logger.debug("Command Data %s", inst['dataObj'])
+            if(inst['dataObj'] != None and self.logger.isEnabledFor(logging.DEBUG)):
+                self.logger.debug("Command Data %s", vars(inst['dataObj']) if isinstance(inst['dataObj'], amf.Object) else inst['dataObj'])
         else:
             self.logger.warning("Unsupported RTMP_TYPE_DATA cmd, CMD: %s", inst['cmd'])
         
-        client_state.metaDataPayload = payload
+        client_state.metaDataPayload = bytes(payload)
         client_state.metaData = inst['dataObj']
-        client_state.audioSampleRate = int(inst['dataObj']['audiosamplerate']);
-        client_state.audioChannels = 2 if inst['dataObj']['stereo'] else 1
-        client_state.videoWidth = int(inst['dataObj']['width']);
-        client_state.videoHeight = int(inst['dataObj']['height']);
-        client_state.videoFps = int(inst['dataObj']['framerate']);
-        client_state.Bitrate = int(inst['dataObj']['videodatarate']);
+        metaData = inst['dataObj']
+        if isinstance(metaData, amf.Object):
+            metaData = vars(metaData)
+        # Fields an encoder leaves out (e.g. audio only streams have no width) keep their current value
+        get = metaData.get
+        client_state.audioSampleRate = int(get('audiosamplerate', client_state.audioSampleRate))
+        client_state.audioChannels = 2 if get('stereo', client_state.audioChannels == 2) else 1
+        client_state.videoWidth = int(get('width', client_state.videoWidth))
+        client_state.videoHeight = int(get('height', client_state.videoHeight))
+        client_state.videoFps = int(get('framerate', client_state.videoFps))
+        client_state.Bitrate = int(get('videodatarate', client_state.Bitrate))
         #TODO: handle Meta Data!
 
     def parse_amf0_invoke_message(self, rtmp_packet):
-        offset = 1 if rtmp_packet['header']['type'] == RTMP_TYPE_FLEX_MESSAGE else 0
-        payload = rtmp_packet['payload'][offset:rtmp_packet['header']['length']]
+        offset = 1 if rtmp_packet.header.type == RTMP_TYPE_FLEX_MESSAGE else 0
+        payload = memoryview(rtmp_packet.payload)[offset:rtmp_packet.header.length]
         amfReader = amf.AMF0(payload)
         inst = {}
-        inst['type'] = rtmp_packet['header']['type']
-        inst['time'] = rtmp_packet['header']['timestamp']
+        inst['type'] = rtmp_packet.header.type
+        inst['time'] = rtmp_packet.clock
         inst['packet'] = rtmp_packet
         
         try:
             inst['cmd'] = amfReader.read()  # first field is command name
-            if rtmp_packet['header']['type'] == RTMP_TYPE_FLEX_MESSAGE or rtmp_packet['header']['type'] == RTMP_TYPE_INVOKE:
+            if rtmp_packet.header.type == RTMP_TYPE_FLEX_MESSAGE or rtmp_packet.header.type == RTMP_TYPE_INVOKE:
                 inst['id'] = amfReader.read()  # second field *may* be message id
                 inst['cmdData'] = amfReader.read()  # third is command data
-                if(inst['cmdData'] != None):
+                if(inst['cmdData'] != None and self.logger.isEnabledFor(logging.DEBUG)):
                     self.logger.debug("Command Data %s", vars(inst['cmdData']))
             else:
                 inst['id'] = 0
-            inst['args'] = []  # others are optional
-            while True:
-                inst['args'].append(amfReader.read())  # amfReader.read()
+            if inst['cmd'] in _IGNORED_ARGS_COMMANDS:
+                inst['args'] = ()
+            else:
+                inst['args'] = []  # others are optional
+                while not amfReader.eof():
+                    inst['args'].append(amfReader.read())
         except EOFError:
             pass
 
-        self.logger.debug("Command %s", inst)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Command %s", inst)
         return inst
     
-    def relativeTime(self, client_id):
-        return int(1000 * (time.time() - self.client_states[client_id]._time0))
+    def relativeTime(self, client_state):
+        return (time.monotonic_ns() - client_state._time0_ns) // 1000000
 
     async def start_server(self):
-        server = await asyncio.start_server(
-            self.handle_client, self.host, self.port)
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: RTMPConnection(self), self.host, self.port)
 
         addr = server.sockets[0].getsockname()
         self.logger.info("RTMP server started on %s", addr)
@@ -878,7 +1092,31 @@ class RTMPServer:
         async with server:
             await server.serve_forever()
 
+    # Coroutine handlers by RTMP message type id, called with (self, client_state, rtmp_packet)
+    PACKET_HANDLERS = {
+        RTMP_TYPE_AUDIO: handle_audio_data,
+        RTMP_TYPE_VIDEO: handle_video_data,
+        RTMP_TYPE_FLEX_MESSAGE: handle_invoke_packet,
+        RTMP_TYPE_DATA: handle_amf_data,
+        RTMP_TYPE_INVOKE: handle_invoke_packet,
+        RTMP_TYPE_ACKNOWLEDGEMENT: handle_bytes_read_report,
+    }
+    # Plain function handlers for protocol control messages, same arguments
+    CONTROL_HANDLERS = {
+        RTMP_TYPE_SET_CHUNK_SIZE: handle_chunk_size_message,
+        RTMP_TYPE_WINDOW_ACKNOWLEDGEMENT_SIZE: handle_window_acknowledgement_size,
+        RTMP_TYPE_SET_PEER_BANDWIDTH: handle_set_peer_bandwidth,
+    }
+    # Coroutine handlers by invoke command name, called with (self, client_state, invoke)
+    INVOKE_HANDLERS = {
+        'connect': handle_connect_command,
+        'createStream': response_createStream,
+        'publish': handle_publish,
+        'play': handle_onPlay,
+    }
+
 # Configure logging level and format
 logging.basicConfig(level=LogLevel, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 rtmp_server = RTMPServer()
-asyncio.run(rtmp_server.start_server())
+with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+    runner.run(rtmp_server.start_server())